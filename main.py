@@ -10,6 +10,11 @@ the participating teams.
 Author: Ryan Johnson
 """
 
+# Columns, other than the Institution column, used when splitting the data into institutions and teams
+DATA_COLUMNS = ["Team Number", "City", "State/Province", "Country", "Advisor", "Problem", "Ranking"]
+# Columns holding only a small set of distinct values, which are stored as categories rather than individual strings
+CATEGORICAL_COLUMNS = ["State/Province", "Country", "Problem", "Ranking"]
+
 
 def get_input_dataframe():
     """
@@ -29,9 +34,20 @@ def get_input_dataframe():
 
         # Ensure the specified .csv file is a valid file
         try:
-            df = pd.read_csv(file_name)
-            # Ensure the file has the required columns
-            if validate_dataframe(df):
+            # Ensure the file has the required columns, reading only its header before loading any data
+            header = pd.read_csv(file_name, nrows=0)
+            if validate_dataframe(header):
+                # Only the columns used when preparing the data are parsed
+                columns = [column for column in header.columns if "Institution" in column or column in DATA_COLUMNS]
+                # Low-cardinality columns are read as strings before becoming categories, so that their categories
+                # are strings even when a column is entirely empty, whichever parser is used
+                dtypes = {column: str for column in CATEGORICAL_COLUMNS}
+                # Use the multithreaded pyarrow parser if it is installed, otherwise falling back to the default parser
+                try:
+                    df = pd.read_csv(file_name, engine="pyarrow", usecols=columns, dtype=dtypes)
+                except ImportError:
+                    df = pd.read_csv(file_name, usecols=columns, dtype=dtypes)
+                df[CATEGORICAL_COLUMNS] = df[CATEGORICAL_COLUMNS].astype("category")
                 return df
         except FileNotFoundError:
             print(f"{file_name} couldn't be found")
@@ -44,30 +60,60 @@ def validate_dataframe(df):
     :param df: Pandas dataframe to be checked
     :return: True if the dataframe has the necessary columns; False otherwise
     """
-    required_columns = ["Institution", "City", "State/Province", "Country"]
+    columns = set(df.columns)
+    # Spreadsheet provided has junk in the Institution title, so accepts any column with 'Institution' contained
+    # within the column title
     columns_not_contained = []
-    for title in required_columns:
-        # Spreadsheet provided has junk in the Institution title, so accepts any column with 'Institution' contained
-        # within the column title
-        if title == "Institution":
-            institution_found = False
-            for column_title in df.columns:
-                if "Institution" in column_title:
-                    institution_found = True
-                    break
-            if not institution_found:
-                columns_not_contained.append(title)
-        elif title not in df.columns:
-            columns_not_contained.append(title)
+    if not any("Institution" in column_title for column_title in columns):
+        columns_not_contained.append("Institution")
+    columns_not_contained += [title for title in ["City", "State/Province", "Country"] if title not in columns]
     if len(columns_not_contained) > 0:
         print(f"File doesn't contain the following required columns: {columns_not_contained}")
         return False
     return True
 
 
+def as_text(values):
+    """
+    Converts a Pandas series into object dtype so that it can be cleaned as text. A column left entirely empty in the
+    .csv file is parsed as floats, which would otherwise cause the cleaning to fail; after conversion its missing
+    values are kept, later being placed into the DB as NULL. Categorical series keep their categories, only changing
+    the type of the categories themselves.
+
+    :param values: Pandas series of strings, possibly containing missing values
+    :return: Pandas series containing the same values with object dtype
+    """
+    if isinstance(values.dtype, pd.CategoricalDtype):
+        return values.cat.rename_categories(values.cat.categories.astype(object))
+    return values.astype(object)
+
+
+def title_case(values):
+    """
+    Converts each value of a Pandas series to title case, ignoring any capitalization already present.
+
+    :param values: Pandas series of strings to be converted
+    :return: Pandas series containing the title-cased values
+    """
+    return as_text(values).str.lower().str.title()
+
+
+def clean_distinct(column, clean):
+    """
+    Cleans a column by applying a cleaning function to only its distinct values, since many rows share the same
+    institution, city, or advisor. Each row then receives the cleaned version of its original value.
+
+    :param column: Pandas series to be cleaned
+    :param clean: Function taking a Pandas series of distinct values and returning their cleaned versions
+    :return: Pandas series containing the cleaned value for each row of the column
+    """
+    codes, uniques = pd.factorize(column, use_na_sentinel=False)
+    return clean(pd.Series(uniques)).take(codes).set_axis(column.index)
+
+
 def prepare_data(df):
     """
-    Loops through a dataframe with the necessary columns and creates two dataframes: one containing only data about
+    Cleans a dataframe with the necessary columns and splits it into two dataframes: one containing only data about
     institutions and the other only containing information about participating teams.
 
     :param df: Pandas dataframe to be used when creating new spreadsheets
@@ -79,43 +125,60 @@ def prepare_data(df):
         if "Institution" in column_name:
             df.rename(columns={column_name: "Institution"}, inplace=True)
 
-    # Holds the unique ID numbers for institutions
-    inst_id_counter = 0
-    inst_ids = {}
-
-    institutions_df = pd.DataFrame()
-    teams_df = pd.DataFrame(columns=["Team Number", "Advisor", "Problem", "Ranking", "Institution ID"])
-    for index, row in df.iterrows():
-        # Add institution data from the row, cleaning the data before entering it into the new spreadsheet
-        institution = row["Institution"]
-        cleaned_institution = institution.split(", - ( )")[0].strip()
-        lowercase_institution = cleaned_institution.lower()
-        if lowercase_institution not in inst_ids.keys():
-            inst_id_counter += 1
-            inst_ids[lowercase_institution] = inst_id_counter
-            row_institution = pd.DataFrame({'Institution ID': [inst_ids[lowercase_institution]],
-                                            'Institution Name': [lowercase_institution.title()],
-                                            'City': [row['City'].lower().title()],
-                                            'State/Province': [row['State/Province'].lower().title() if type(
-                                                row['State/Province']) is str else None],
-                                            'Country': [row['Country'].lower().title() if type(
-                                                row['Country']) is str else None]})
-            institutions_df = pd.concat([institutions_df, row_institution], ignore_index=True)
-            institutions_df = institutions_df.reset_index(drop=True)
-
-        # Add team data from the row if the team isn't already present
-        if not teams_df['Team Number'].isin([row['Team Number']]).any():
-            row_team = pd.DataFrame({'Team Number': [row['Team Number']],
-                                     'Advisor': [row['Advisor'].lower().title()],
-                                     'Problem': [row['Problem'].capitalize() if type(row['Problem']) == str else None],
-                                     'Ranking': [row['Ranking'].lower().title()],
-                                     'Institution ID': [inst_ids[lowercase_institution]]})
-            teams_df = pd.concat([teams_df, row_team], ignore_index=True)
-            teams_df = teams_df.reset_index(drop=True)
-
+    # Clean each distinct institution name once, the lowercase name acting as the key identifying each institution
+    name_codes, names = pd.factorize(df["Institution"], use_na_sentinel=False)
+    name_keys = as_text(pd.Series(names)).str.split(", - ( )", regex=False).str[0].str.strip().str.lower()
+
+    # Number the institutions in order of appearance, with differently written names sharing the same key also sharing
+    # an ID. Each row receives the ID of its institution by indexing into the IDs of the distinct names, avoiding a
+    # second pass of hashing over every row
+    key_codes, unique_insts = pd.factorize(name_keys, sort=False)
+    inst_codes = key_codes[name_codes]
+    row_inst_ids = pd.Series(inst_codes + 1, index=df.index)
+
+    # The first row seen for each institution supplies its location data, grouping by the institution codes rather
+    # than hashing the institution names a second time
+    inst_locations = df[['City', 'State/Province', 'Country']]
+    first_inst_rows = inst_locations.groupby(inst_codes, sort=False).head(1).reset_index(drop=True)
+    institutions_df = pd.DataFrame({'Institution ID': range(1, len(unique_insts) + 1),
+                                    'Institution Name': pd.Series(unique_insts).str.title(),
+                                    'City': clean_distinct(first_inst_rows['City'], title_case),
+                                    'State/Province': title_case(first_inst_rows['State/Province']),
+                                    'Country': title_case(first_inst_rows['Country'])})
+
+    # Only the first row for each team number is kept, cleaning the team data in bulk
+    first_team_rows = ~df['Team Number'].duplicated()
+    teams_df = pd.DataFrame({'Team Number': df.loc[first_team_rows, 'Team Number'],
+                             'Advisor': clean_distinct(df.loc[first_team_rows, 'Advisor'], title_case),
+                             'Problem': as_text(df.loc[first_team_rows, 'Problem']).str.capitalize(),
+                             'Ranking': title_case(df.loc[first_team_rows, 'Ranking']),
+                             'Institution ID': row_inst_ids[first_team_rows]})
+    teams_df = teams_df.reset_index(drop=True)
+
+    # Store the ID numbers using the smallest integer type able to hold them
+    institutions_df['Institution ID'] = pd.to_numeric(institutions_df['Institution ID'], downcast='integer')
+    for column in ['Team Number', 'Institution ID']:
+        teams_df[column] = pd.to_numeric(teams_df[column], downcast='integer')
     return institutions_df, teams_df
 
 
+def insert_or_ignore(table, conn, keys, data_iter):
+    """
+    Insertion method used with Pandas' to_sql, inserting all rows of a dataframe at once while skipping any row whose
+    primary key is already present within the database table.
+
+    :param table: Pandas SQL table being written to
+    :param conn: Database cursor used to execute the insertion
+    :param keys: List of column names being inserted
+    :param data_iter: Iterable of tuples, each tuple holding the values for a single row
+    :return: Number of rows inserted into the database table
+    """
+    columns = ", ".join(keys)
+    placeholders = ", ".join(["?"] * len(keys))
+    conn.executemany(f"INSERT OR IGNORE INTO {table.name} ({columns}) VALUES ({placeholders})", data_iter)
+    return conn.rowcount
+
+
 def populate_db(inst_df, teams_df):
     """
     Populates a SQLite database with the two cleaned dataframes. One dataframe contains institution data, and the other
@@ -127,43 +190,36 @@ def populate_db(inst_df, teams_df):
     """
     print("Populating the database...")
     conn = sqlite3.connect('math_competition.db')
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
     cursor = conn.cursor()
 
     # Populate the Institutions table
     cursor.execute("CREATE TABLE IF NOT EXISTS institutions (id INTEGER PRIMARY KEY, name VARCHAR, city VARCHAR, "
                    "state_province VARCHAR, country VARCHAR)")
-    for index, row in inst_df.iterrows():
-        name = row['Institution Name']
-        cursor.execute("SELECT id FROM institutions WHERE name=?", (name,))
-        # Ensure that no duplicate entries are placed into the DB
-        if cursor.fetchone() is not None:
-            print(f"Didn't put duplicate institution into the DB ({name})")
-            continue
-
-        inst_id = row['Institution ID']
-        city = row['City']
-        state_province = row['State/Province']
-        country = row['Country']
-        cursor.execute("INSERT INTO institutions (id, name, city, state_province, country) VALUES (?, ?, ?, ?, ?)",
-                       (inst_id, name, city, state_province, country))
+    # Ensure that no duplicate entries are placed into the DB
+    inst_table = inst_df.rename(columns={'Institution ID': 'id', 'Institution Name': 'name', 'City': 'city',
+                                         'State/Province': 'state_province', 'Country': 'country'})
+    num_inserted = inst_table.to_sql('institutions', conn, if_exists='append', index=False, method=insert_or_ignore)
+    if num_inserted < len(inst_df):
+        print(f"Didn't put {len(inst_df) - num_inserted} duplicate institution(s) into the DB")
 
     # Populate the Teams table
     cursor.execute("CREATE TABLE IF NOT EXISTS teams (id INTEGER PRIMARY KEY, advisor VARCHAR, problem VARCHAR, "
                    "ranking VARCHAR, institution_id INTEGER, FOREIGN KEY (institution_id) REFERENCES institutions(id))")
-    for index, row in teams_df.iterrows():
-        team_id = row['Team Number']
-        cursor.execute("SELECT id FROM teams WHERE id=?", (team_id,))
-        # Ensure that no duplicate entries are placed into the DB
-        if cursor.fetchone() is not None:
-            print(f"Didn't put duplicate team into the DB (#{team_id})")
-            continue
-
-        advisor = row['Advisor']
-        problem = row['Problem']
-        ranking = row['Ranking']
-        inst_id = row['Institution ID']
-        cursor.execute("INSERT INTO teams (id, advisor, problem, ranking, institution_id) VALUES (?, ?, ?, ?, ?)",
-                       (team_id, advisor, problem, ranking, inst_id))
+    # Ensure that no duplicate entries are placed into the DB
+    teams_table = teams_df.rename(columns={'Team Number': 'id', 'Advisor': 'advisor', 'Problem': 'problem',
+                                           'Ranking': 'ranking', 'Institution ID': 'institution_id'})
+    num_inserted = teams_table.to_sql('teams', conn, if_exists='append', index=False, method=insert_or_ignore)
+    if num_inserted < len(teams_df):
+        print(f"Didn't put {len(teams_df) - num_inserted} duplicate team(s) into the DB")
+
+    # Index the columns used when joining and filtering in the analytical queries, gathering statistics afterward so
+    # that the query planner makes use of them
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_teams_inst ON teams(institution_id)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_teams_rank ON teams(ranking)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_inst_country ON institutions(country)")
+    cursor.execute("ANALYZE")
 
     conn.commit()
     conn.close()
@@ -183,11 +239,8 @@ def make_queries():
     cursor = conn.cursor()
 
     # Determine average number of teams entered per institution
-    cursor.execute("SELECT COUNT(*) FROM teams")
-    num_teams = cursor.fetchall()[0][0]
-    cursor.execute("SELECT COUNT(*) FROM institutions")
-    num_insts = cursor.fetchall()[0][0]
-    mean_num_teams = num_teams / num_insts
+    cursor.execute("SELECT 1.0 * (SELECT COUNT(*) FROM teams) / (SELECT COUNT(*) FROM institutions)")
+    mean_num_teams = cursor.fetchone()[0]
 
     # Determine the institutions that entered the most teams, including the number of teams that they entered
     cursor.execute("SELECT i.name, COUNT(*) "
@@ -195,7 +248,7 @@ def make_queries():
                    "FROM teams t "
                    "INNER JOIN institutions i ON i.id = t.institution_id "
                    "GROUP BY institution_id "
-                   "ORDER BY num_teams DESC")
+                   "ORDER BY num_teams DESC, institution_id DESC")
     ordered_insts = cursor.fetchall()
 
     # Determine the institutions whose team(s) earned 'Outstanding' rankings (ordered by institution name)
@@ -209,7 +262,8 @@ def make_queries():
     cursor.execute("SELECT t.id "
                    "FROM teams t "
                    "INNER JOIN institutions i ON t.institution_id=i.id "
-                   "WHERE t.ranking IN ('Outstanding Winner', 'Finalist', 'Meritorious') AND i.country='Usa'")
+                   "WHERE t.ranking IN ('Outstanding Winner', 'Finalist', 'Meritorious') AND i.country='Usa' "
+                   "ORDER BY t.id")
     usa_meritorious_teams = cursor.fetchall()
 
     return mean_num_teams, ordered_insts, outstanding_insts, usa_meritorious_teams
@@ -249,8 +303,6 @@ if __name__ == "__main__":
     print("Welcome to the Math Modeling Contest spreadsheet analyzer. To analyze data from a year's contest, "
           "enter the name of a valid .csv file.")
     df = get_input_dataframe()
-    if not validate_dataframe(df):
-        exit(1)
 
     inst_df, teams_df = prepare_data(df)
     populate_db(inst_df, teams_df)